@@ -18,27 +18,69 @@
 # specifically we are talking about 2F+1 acceptors.
 # NB:: A node can be both an acceptor and a proposer.
 
-import time
-import random
+import os
+import zlib
+import queue
+import pickle
+import struct
+import asyncio
+import itertools
 import logging
+import threading
+import concurrent.futures
+from collections import deque
+from enum import IntEnum
 
+try:
+    # optional; a drop-in replacement for the asyncio event loop.
+    import uvloop
+except ImportError:
+    uvloop = None
 
-logger = logging.getLogger()
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(message)s\n')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.setLevel('DEBUG')
 
+# the application decides where logs go, see main().
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
 
-class Client(object):
+
+class Status(IntEnum):
+    CONFLICT = 0
+    CONFIRM = 1
+
+
+# acceptors confirm an accept with this exact tuple.
+# a conflict is (Status.CONFLICT, the ballot number that beat ours); proposers tell it apart with an identity
+# check on its first item.
+_CONFIRM = (Status.CONFIRM, Status.CONFIRM)
+
+
+# every record in an acceptor's log is this header, (length, crc32) of the payload, followed by the payload.
+_RECORD_HEADER = struct.Struct(">II")
+
+
+class QuorumError(Exception):
+    """
+    raised when a proposer does not get a quorum of confirmations from the acceptors within its timeout.
+    confirmed is the number of acceptors that did confirm.
+    ballot is the highest ballot number that conflicting acceptors told us about, None if there were no conflicts.
+    unanswered is the number of acceptors that were sent the msg but did not answer it; they may still act on it.
+    """
+
+    def __init__(self, message, confirmed=0, ballot=None, unanswered=0):
+        super().__init__(message)
+        self.confirmed = confirmed
+        self.ballot = ballot
+        self.unanswered = unanswered
+
+
+class Client:
     """
     1. A client submits the f change function to a proposer.
     """
     pass
 
 
-class Proposer(object):
+class Proposer:
     """
     2. The proposer generates a ballot number, B, and sends "prepare" messages containing that number
     to the acceptors.
@@ -50,123 +92,331 @@ class Proposer(object):
     10. Waits for the F + 1 confirmations.
     11. Returns the new state to the client.
     """
+    __slots__ = (
+        "acceptors", "_prepares", "_accepts", "_prepare_and_accepts",
+        "F", "quorum", "prepare_quorum", "accept_quorum", "state", "_ballot_counter", "node_id", "timeout",
+        "_prepared_ballot", "_prepared_state")
 
-    def __init__(self, acceptors):
+    def __init__(self, acceptors, timeout=5, prepare_quorum=None, accept_quorum=None, node_id=None):
         # TODO: note that a node can be both a proposer and an acceptor at the same time
         # in fact most times they usually are.
         # So we should add logic to handle that fact.
-        if not isinstance(acceptors, list):
-            raise ValueError("acceptors ought to be a list of child classes of Acceptor object")
-        self.acceptors = acceptors
+        # any iterable of acceptors will do; we keep our own snapshot of it.
+        self.acceptors = tuple(acceptors)
+        # the acceptor methods each phase calls, bound once up front.
+        self._prepares = tuple(acceptor.prepare for acceptor in self.acceptors)
+        self._accepts = tuple(acceptor.accept for acceptor in self.acceptors)
+        self._prepare_and_accepts = tuple(acceptor.prepare_and_accept for acceptor in self.acceptors)
         # since we need to have 2F+1 acceptors to tolerate F failures, then:
-        self.F = (len(self.acceptors) - 1) / 2
+        self.F = (len(self.acceptors) - 1) // 2
+        # F + 1, a simple majority of the acceptors.
+        self.quorum = len(self.acceptors) // 2 + 1
+        # the prepare and accept phases can each wait for a different number of confirmations,
+        # eg a smaller prepare quorum in exchange for a bigger accept quorum. This is only safe
+        # as long as any prepare quorum overlaps any accept quorum.
+        self.prepare_quorum = prepare_quorum or self.quorum
+        self.accept_quorum = accept_quorum or self.quorum
+        if self.prepare_quorum + self.accept_quorum <= len(self.acceptors):
+            raise ValueError("prepare_quorum + accept_quorum ought to be greater than the number of acceptors")
+        if max(self.prepare_quorum, self.accept_quorum) > len(self.acceptors):
+            raise ValueError("prepare_quorum and accept_quorum can not exceed the number of acceptors")
         self.state = 0
+        # ballot numbers are (n, ID) tuples, see generate_ballot_number.
+        # node_id has to be unique among the proposers sharing these acceptors.
+        self._ballot_counter = itertools.count(1)
+        self.node_id = id(self) if node_id is None else node_id
+        # seconds to wait for F + 1 acceptors to confirm a phase.
+        self.timeout = timeout
+        # the ballot we piggybacked a 'prepare' for on our last 'accept' msg, and the state its confirmations gave.
+        self._prepared_ballot = None
+        self._prepared_state = None
         logger.info(
-            "Init Proposer. acceptors={0}. F={1}. initial_state={2}".format(
-                self.acceptors, self.F, self.state))
+            "Init Proposer. acceptors=%s. F=%s. initial_state=%s",
+            self.acceptors, self.F, self.state)
 
-    def receive(self, f):
+    async def receive(self, f):
         """
         receives f change function from client and begins consensus process.
+
+        If other proposers got ahead of us, the round is retried once with a ballot number past theirs,
+        as long as no acceptor can have taken the result of f yet: either the prepare phase failed, or every
+        acceptor that was sent the 'accept' msg answered it with a conflict.
+
+        f ought to be a pure function of the state: a retry applies it again,
+        to whatever state the acceptors hold by then.
+        """
+        notLessThan = (0, 0)
+        for retry in (False, True):
+            accepting = False
+            try:
+                if self._prepared_ballot is not None:
+                    # our previous round already sent the 'prepare' msg for this ballot along with its
+                    # 'accept' msg, so we can go straight to the accept phase.
+                    ballot_number = self._prepared_ballot
+                    self.state = self._prepared_state
+                    logger.info("receive. change_func=%s. ballot_number=%s. prepared.", f, ballot_number)
+                else:
+                    #  Generate ballot number, B and sends 'prepare' msg with that number to the acceptors.
+                    ballot_number = self.generate_ballot_number(notLessThan=notLessThan)
+                    logger.info("receive. change_func=%s. ballot_number=%s.", f, ballot_number)
+                    await self.send_prepare(ballot_number=ballot_number)
+                # if this round fails, the next one has to start with a fresh prepare phase.
+                self._prepared_ballot = self._prepared_state = None
+
+                next_ballot_number = self.generate_ballot_number(notLessThan=ballot_number)
+                accepting = True
+                result = await self.send_accept(f, ballot_number, next_ballot_number=next_ballot_number)
+                return result
+            except QuorumError as e:
+                self._prepared_ballot = self._prepared_state = None
+                if retry or e.ballot is None or (accepting and (e.confirmed or e.unanswered)):
+                    # already retried, timed out, or some acceptors may hold (or still take) the result of f.
+                    raise
+                # CONFLICT: fast-forward our ballot number's counter past the highest number the
+                # conflicting acceptors saw, so that the retry can succeed.
+                # borrowed from: https://github.com/peterbourgon/caspaxos/blob/4374c3a816d7abd6a975e0e644782f0d03a2d05d/protocol/local_proposer.go#L148-L154
+                notLessThan = e.ballot
+
+    async def batch_receive(self, funcs):
         """
-        #  Generate ballot number, B and sends 'prepare' msg with that number to the acceptors.
-        ballot_number = self.generate_ballot_number()
-        logger.info("receive. change_func={0}. ballot_number={1}.".format(f, ballot_number))
-        self.send_prepare(ballot_number=ballot_number)
-        result = self.send_accept(f, ballot_number)
-        return result
-
-    def generate_ballot_number(self, notLessThan=0):
+        receives several change functions and runs them, in order, in a single consensus round.
+        returns the state each of them produced.
+        """
+        states = []
+
+        def batch(state):
+            # should a round apply its change function more than once, only the last application counts.
+            del states[:]
+            for f in funcs:
+                state = f(state)
+                states.append(state)
+            return state
+
+        await self.receive(batch)
+        return states
+
+    def generate_ballot_number(self, notLessThan=(0, 0)):
         """
         http://rystsov.info/2015/09/16/how-paxos-works.html
         Each server may have unique ID and use an increasing sequence of natural number n to generate (n,ID) tuples and use tuples as ballot numbers.
         To compare them we start by comparing the first element from each tuple. If they are equal, we use the second component of the tuple (ID) as a tie breaker.
         Let IDs of two servers are 0 and 1 then two sequences they generate are (0,0),(1,0),(2,0),(3,0).. and (0,1),(1,1),(2,1),(3,1).. Obviously they are unique, ordered and for any element in one we always can peak an greater element from another.
         """
-        # we should never generate a random number that is equal to zero
-        # since Acceptor.promise defaults to 0
-        ballot_number = random.randint(notLessThan + 1, 100)
-        return ballot_number
-
-    def send_prepare(self, ballot_number):
-        confirmations = []  # list of tuples conatining accepted (value, ballotNumOfAcceptedValue)
-        for acceptor in self.acceptors:
-            confirmation = acceptor.prepare(ballot_number=ballot_number)
-            if confirmation[0] == "CONFLICT":
-                # CONFLICT, do something
-                # We should fast-forward our ballot number's counter to
-                # the highest number we saw from the conflicted preparers, so a
-                # subsequent proposal might succeed. We could try to re-submit the same
-                # request with our updated ballot number, but for now let's leave that
-                # responsibility to the caller.
-                # borrowed from: https://github.com/peterbourgon/caspaxos/blob/4374c3a816d7abd6a975e0e644782f0d03a2d05d/protocol/local_proposer.go#L148-L154
-                pass
-            else:
-                confirmations.append(confirmation)
-
-        # Wait for the F + 1 confirmations
-        while True:
-            if len(confirmations) >= self.F + 1:
-                break
-            else:
-                # sleep then check again
-                logger.info(
-                    "sleep waiting for accept confirms. confirmations={0}. F={1}.".format(
-                        len(confirmations), self.F))
-                time.sleep(5)
-
-        total_list_of_confirmation_values = []
-        for i in confirmations:
-            total_list_of_confirmation_values.append(i[0])
-
+        # n starts at 1 so we never generate (0, 0), which Acceptor.promise defaults to.
+        n = next(self._ballot_counter)
+        if n <= notLessThan[0]:
+            n = notLessThan[0] + 1
+            self._ballot_counter = itertools.count(n + 1)
+        return (n, self.node_id)
+
+    async def send_prepare(self, ballot_number):
         # If they(confirmations) all contain the empty value,
         # then the proposer defines the current state as PHI otherwise it picks the
         # value of the tuple with the highest ballot number.
-        if sum(total_list_of_confirmation_values) == 0:
-            # we are using 0 as PHI
-            self.state = 0
-        else:
-            highest_confirmation = self.get_highest_confirmation(confirmations)
-            self.state = highest_confirmation[0]
-
-    def get_highest_confirmation(self, confirmations):
-        ballots = []
-        for i in confirmations:
-            ballots.append(i[1])
-        ballots = sorted(ballots)
-        highestBallot = ballots[len(ballots) - 1]
+        # We are using 0 as PHI and the empty value is (0, (0, 0)), so starting from it
+        # and keeping the highest confirmation as they arrive covers both cases.
+        best = (0, (0, 0))  # tuple conatining accepted (value, ballotNumOfAcceptedValue)
+        async for _, confirmation in self.quorum_replies(
+                self._prepares, (ballot_number,), quorum=self.prepare_quorum):
+            if confirmation[1] > best[1]:
+                best = confirmation
+        self.state = best[0]
+
+    async def wait_for_quorum(self, methods, args, quorum=None):
+        """
+        calls the acceptor methods concurrently with the positional args and returns the confirmations,
+        keyed by acceptor, as soon as quorum (F + 1 by default) of them confirm.
+        """
+        return {
+            acceptor: confirmation
+            async for acceptor, confirmation in self.quorum_replies(methods, args, quorum)}
 
-        for i in confirmations:
-            if i[1] == highestBallot:
-                return i
+    async def quorum_replies(self, methods, args, quorum=None):
+        """
+        calls the acceptor methods concurrently with the positional args and yields each (acceptor, confirmation)
+        as it arrives until quorum (F + 1 by default) distinct acceptors have confirmed.
+        requests that are still in flight by then are cancelled.
+        An acceptor whose request fails (eg its disk did) is treated like one that never answered.
 
-    def send_accept(self, f, ballot_number):
+        Every acceptor is asked up front, so a slow or dead acceptor costs nothing as long as a quorum of
+        the others answers.
+        """
+        if quorum is None:
+            quorum = self.quorum
+        # keyed by acceptor, so an acceptor that answers more than once is only counted once.
+        confirmations = {}
+        highest_conflict = None
+
+        # every request that completes is queued up in answered and wakes us up through arrived,
+        # so waking up costs the same however many requests are still in flight.
+        answered = deque()
+        arrived = asyncio.Event()
+
+        def on_answer(task):
+            answered.append(task)
+            arrived.set()
+
+        tasks = {}  # task -> the acceptor it asked
+        for method in methods:
+            task = asyncio.create_task(method(*args))
+            task.add_done_callback(on_answer)
+            tasks[task] = method.__self__
+        handled = 0
+        failed = 0
+        # the timer can go off in the same loop iteration as a reply; arrived then only wakes us up once,
+        # so the timeout is remembered here and checked on every pass.
+        timed_out = []
+
+        def on_timeout():
+            timed_out.append(True)
+            arrived.set()
+
+        timer = asyncio.get_running_loop().call_later(self.timeout, on_timeout)
+        try:
+            # Wait for the quorum of confirmations
+            while len(confirmations) < quorum and handled < len(tasks):
+                if not answered:
+                    if timed_out:
+                        break
+                    arrived.clear()
+                    await arrived.wait()
+                    continue
+
+                task = answered.popleft()
+                handled += 1
+                acceptor = tasks[task]
+                error = task.exception()
+                if error is not None:
+                    # it may have changed its state before failing, so it still counts as unanswered.
+                    failed += 1
+                    logger.info("acceptor failed. acceptor=%s. error=%r", acceptor, error)
+                    continue
+                reply = task.result()
+                if reply[0] is Status.CONFLICT:
+                    # keep the highest ballot number the conflicting acceptors saw; if we end up without
+                    # a quorum, the caller can fast-forward past it (QuorumError.ballot).
+                    if highest_conflict is None or reply[1] > highest_conflict:
+                        highest_conflict = reply[1]
+                    continue
+                if acceptor in confirmations:
+                    # a repeated answer does not count twice.
+                    continue
+                confirmations[acceptor] = reply
+                yield acceptor, reply
+        finally:
+            timer.cancel()
+            for task in tasks:
+                if not task.cancel() and not task.cancelled():
+                    # already done; mark its error, if any, as seen.
+                    task.exception()
+
+        if len(confirmations) < quorum:
+            raise QuorumError(
+                "did not get enough confirmations. confirmations={0}. quorum={1}.".format(
+                    len(confirmations), quorum),
+                confirmed=len(confirmations),
+                ballot=highest_conflict,
+                unanswered=len(tasks) - handled + failed)
+
+    async def send_accept(self, f, ballot_number, next_ballot_number=None):
         """
         7. Applies the f function to the current state and sends the result, new state, along with the generated ballot number B (an "accept" message) to the acceptors.
+
+        If next_ballot_number is given, the 'prepare' msg for it rides along with the 'accept' msg
+        so that the next call to receive can skip the prepare phase.
         """
-        self.state = f(self.state)
-        acceptations = []
-        for acceptor in self.acceptors:
-            acceptation = acceptor.accept(ballot_number=ballot_number, new_state=self.state)
-            if acceptation[0] == "CONFLICT":
-                # CONFLICT, do something
-                pass
-            else:
-                acceptations.append(acceptation)
-
-        # Wait for the F + 1 confirmations
-        while True:
-            if len(acceptations) >= self.F + 1:
-                break
-            else:
-                # sleep then check again
-                time.sleep(5)
+        # a local, since other calls to receive may change self.state while we wait for the acceptors.
+        new_state = f(self.state)
+        self.state = new_state
+        if next_ballot_number is None:
+            await self.wait_for_quorum(
+                self._accepts, (ballot_number, new_state), quorum=self.accept_quorum)
+        else:
+            # each confirmation counts towards both phases, so it has to satisfy both quorums.
+            # keep the highest confirmation as they arrive, like send_prepare does.
+            best = (0, (0, 0))
+            async for _, confirmation in self.quorum_replies(
+                    self._prepare_and_accepts,
+                    (ballot_number, new_state, next_ballot_number),
+                    quorum=max(self.prepare_quorum, self.accept_quorum)):
+                if confirmation[1] > best[1]:
+                    best = confirmation
+            self._prepared_ballot = next_ballot_number
+            self._prepared_state = best[0]
 
         # Returns the new state to the client.
-        return self.state
+        return new_state
 
 
-class Acceptor(object):
+class Batcher:
+    """
+    Collects change functions submitted by many clients and hands them to a proposer in batches,
+    so that up to max_batch changes share one consensus round.
+    A batch is sent once it is full or batch_window_ms after its first change arrived.
+    """
+    __slots__ = ("proposer", "batch_window", "max_batch", "_queue")
+
+    def __init__(self, proposer, batch_window_ms=5, max_batch=64):
+        self.proposer = proposer
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = None
+
+    def _get_queue(self):
+        # made on first use rather than in __init__: before python 3.10 an asyncio.Queue sticks to the event
+        # loop that was current when it was made, which need not be the one that runs us.
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def submit(self, f):
+        """
+        queues the f change function and returns the state it produced once its batch is accepted.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._get_queue().put((f, future))
+        return await future
+
+    async def run(self):
+        """
+        sends batches to the proposer until cancelled; run it as a task alongside the clients.
+        """
+        loop = asyncio.get_running_loop()
+        pending = self._get_queue()
+        while True:
+            batch = [await pending.get()]
+            try:
+                flush_at = loop.time() + self.batch_window
+                while len(batch) < self.max_batch:
+                    timeout = flush_at - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(pending.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                states = await self.proposer.batch_receive([f for f, _ in batch])
+            except BaseException as e:
+                # the whole batch shared one round, so they all share its failure.
+                # if we got cancelled (CancelledError is an Exception before python 3.8), so do they;
+                # either way none of them is left waiting.
+                cancelled = isinstance(e, asyncio.CancelledError) or not isinstance(e, Exception)
+                for _, future in batch:
+                    if not future.done():
+                        if cancelled:
+                            future.cancel()
+                        else:
+                            future.set_exception(e)
+                if cancelled:
+                    raise
+                continue
+            for (_, future), state in zip(batch, states):
+                if not future.done():
+                    future.set_result(state)
+
+
+class Acceptor:
     """
     3. Returns a conflict if it already saw a greater ballot number.
     else
@@ -178,13 +428,121 @@ class Acceptor(object):
     8. Returns a conflict if it already saw a greater ballot number.
     9. Erases the promise, marks the received tuple (ballot number, value) as the accepted value and returns a confirmation
     """
-    promise = 0  # ballot number
-    accepted = (0, 0)
+    __slots__ = ("name", "promise", "accepted", "_fd", "_pending", "_batch", "_flusher", "_durable", "_error")
 
-    def __init__(self, name):
+    def __init__(self, name, path=None):
         self.name = name
-
-    def prepare(self, ballot_number):
+        self.promise = (0, 0)  # ballot number
+        self.accepted = (0, (0, 0))
+        # with a path, promise and accepted are persisted to an append-only log there,
+        # and read back from it on start up.
+        self._fd = None
+        self._pending = []  # log records waiting for the next flush
+        self._batch = None  # future that the next flush resolves
+        self._flusher = None
+        self._error = None  # why the log last failed, if it did
+        if path is not None:
+            if os.path.exists(path):
+                self._recover(path)
+            self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # (promise, accepted) as of the last record that made it to disk.
+        self._durable = self.promise, self.accepted
+
+    def _recover(self, path):
+        """
+        reads promise and accepted back from the last complete record in the log.
+        A crash in the middle of a write leaves a torn record at the end; it is cut off, since it was never
+        flushed and so never confirmed to any proposer.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        last = None
+        while offset + _RECORD_HEADER.size <= len(data):
+            length, crc = _RECORD_HEADER.unpack_from(data, offset)
+            start = offset + _RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            last = payload
+            offset = start + length
+        if offset < len(data):
+            logger.info("acceptor log has a torn record, truncating it. name=%s. path=%s. offset=%s",
+                        self.name, path, offset)
+            os.truncate(path, offset)
+        if last is not None:
+            self.promise, self.accepted = pickle.loads(last)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    async def _persist(self, before):
+        """
+        appends the current promise and accepted value to the log and returns once they are on disk.
+        before is the (promise, accepted) they replaced; if the new ones can not be written, they are
+        rolled back to it and the error is raised right away rather than on the next start up.
+        Group commit: whatever gets persisted while a flush is in progress is written and fsync-ed
+        together in the next one, so a busy acceptor pays one fsync per batch rather than per msg.
+
+        Once a write or fsync fails, we can no longer tell what is on disk; the acceptor goes back to the
+        last state that made it there and fails every msg after that, until it is restarted from its log.
+        """
+        if self._fd is None:
+            return
+        if self._error is not None:
+            self.promise, self.accepted = before
+            raise OSError("acceptor log failed earlier. name={0}.".format(self.name)) from self._error
+        try:
+            payload = pickle.dumps((self.promise, self.accepted), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            self.promise, self.accepted = before
+            raise
+        loop = asyncio.get_running_loop()
+        self._pending.append(_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        if self._batch is None:
+            self._batch = loop.create_future()
+        batch = self._batch
+        if self._flusher is None:
+            self._flusher = loop.create_task(self._flush())
+        # shielded, so that a proposer giving up on us does not cancel the flush for the rest of the batch.
+        await asyncio.shield(batch)
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                records, self._pending = self._pending, []
+                batch, self._batch = self._batch, None
+                # every change is appended to _pending as soon as it is made, so this is what records ends with.
+                durable = self.promise, self.accepted
+                if self._error is not None:
+                    # queued up while the previous flush failed.
+                    batch.set_exception(OSError("acceptor log failed earlier. name={0}.".format(self.name)))
+                    continue
+                try:
+                    await loop.run_in_executor(None, self._write, b"".join(records))
+                except Exception as e:
+                    logger.error("acceptor log failed. name=%s. error=%r", self.name, e)
+                    self._error = e
+                    # none of the msgs in this batch (or queued up behind it) have been confirmed yet.
+                    self.promise, self.accepted = self._durable
+                    batch.set_exception(e)
+                else:
+                    self._durable = durable
+                    batch.set_result(None)
+        finally:
+            self._flusher = None
+
+    def _write(self, data):
+        # os.write may write less than it was given.
+        data = memoryview(data)
+        while data:
+            data = data[os.write(self._fd, data):]
+        os.fsync(self._fd)
+
+    async def prepare(self, ballot_number):
         """
         3. Returns a conflict if it already saw a greater ballot number.
         else
@@ -193,40 +551,135 @@ class Acceptor(object):
         or
         with a tuple of an accepted value and its ballot number.
         """
-        logger.info("prepare. name={0}. ballot_number={1}. promise={2}. accepted={3}".format(
-            self.name, ballot_number, self.promise, self.accepted))
+        before = self.promise, self.accepted
+        confirmation = self._prepare(ballot_number)
+        if confirmation[0] is not Status.CONFLICT:
+            await self._persist(before)
+        return confirmation
+
+    def _prepare(self, ballot_number):
+        # runs for every acceptor on every round, so only trace it at DEBUG level.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("prepare. name=%s. ballot_number=%s. promise=%s. accepted=%s",
+                         self.name, ballot_number, self.promise, self.accepted)
         if self.promise > ballot_number:
-            return ("CONFLICT", "CONFLICT")
-  
-        # this ought to be flushed to disk
+            return (Status.CONFLICT, self.promise)
+
         self.promise = ballot_number
         return self.accepted
 
-    def accept(self, ballot_number, new_state):
+    async def accept(self, ballot_number, new_state):
         """
         8. Returns a conflict if it already saw a greater ballot number.
         9. Erases the promise, marks the received tuple (ballot number, value) as the accepted value and returns a confirmation
         """
-        logger.info("accept. name={0}. ballot_number={1}. new_state={2}. promise={3}. accepted={4}".format(
-            self.name, ballot_number, new_state, self.promise, self.accepted))
+        before = self.promise, self.accepted
+        acceptation = self._accept(ballot_number, new_state)
+        if acceptation is _CONFIRM:
+            await self._persist(before)
+        return acceptation
+
+    def _accept(self, ballot_number, new_state):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("accept. name=%s. ballot_number=%s. new_state=%s. promise=%s. accepted=%s",
+                         self.name, ballot_number, new_state, self.promise, self.accepted)
         if self.promise > ballot_number:
-            return ("CONFLICT", "CONFLICT")
+            return (Status.CONFLICT, self.promise)
         elif self.accepted[1] > ballot_number:
             # https://github.com/peterbourgon/caspaxos/blob/4374c3a816d7abd6a975e0e644782f0d03a2d05d/protocol/memory_acceptor.go#L118-L128
-            return ("CONFLICT", "CONFLICT")
+            return (Status.CONFLICT, self.accepted[1])
 
-        # these two ought to be flushed to disk
         # http://rystsov.info/2015/09/16/how-paxos-works.html
-        self.promise = 0
+        self.promise = (0, 0)
         self.accepted = (new_state, ballot_number)
-        return ("CONFIRM", "CONFIRM")
+        return _CONFIRM
+
+    async def prepare_and_accept(self, ballot_number, new_state, next_ballot_number):
+        """
+        an 'accept' msg for ballot_number with a 'prepare' msg for next_ballot_number piggybacked on it.
+        Returns a conflict if the accept fails, otherwise the confirmation of the prepare.
+        """
+        before = self.promise, self.accepted
+        acceptation = self._accept(ballot_number, new_state)
+        if acceptation[0] is Status.CONFLICT:
+            return acceptation
+        # we only reply once both are done, so they can go to disk together.
+        confirmation = self._prepare(next_ballot_number)
+        await self._persist(before)
+        return confirmation
+
+
+class ThreadedAcceptor:
+    """
+    Runs an acceptor on a thread of its own, much like it would run on a node of its own.
+    Proposers talk to it just like they talk to an Acceptor; every msg is put in a mailbox that only
+    the acceptor's thread reads from, and the reply comes back on a future.
+    Reading attributes (name, promise, accepted, ...) goes straight to the wrapped acceptor.
+    """
+    __slots__ = ("acceptor", "_mbox", "_thread")
+
+    def __init__(self, acceptor):
+        self.acceptor = acceptor
+        # many proposers may put, only our thread gets; SimpleQueue is enough for that.
+        self._mbox = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._serve, name=acceptor.name, daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.acceptor, name)
+
+    def _serve(self):
+        loop = asyncio.new_event_loop()
+        try:
+            stopping = False
+            while not stopping:
+                # wait for a msg, then take every other msg that is already in the mailbox as well and handle
+                # them all concurrently, so that the acceptor can persist them in one flush.
+                # msgs that come in meanwhile make up the next batch.
+                msgs = [self._mbox.get()]
+                while True:
+                    try:
+                        msgs.append(self._mbox.get_nowait())
+                    except queue.Empty:
+                        break
+                tasks = []
+                for op, args, reply in msgs:
+                    if op is None:
+                        stopping = True
+                    elif reply.set_running_or_notify_cancel():
+                        tasks.append(loop.create_task(self._handle(op, args, reply)))
+                    # else the proposer stopped waiting for it before we got to it.
+                if tasks:
+                    loop.run_until_complete(asyncio.wait(tasks))
+        finally:
+            loop.close()
+
+    async def _handle(self, op, args, reply):
+        try:
+            reply.set_result(await getattr(self.acceptor, op)(*args))
+        except Exception as e:
+            reply.set_exception(e)
+
+    async def _send(self, op, *args):
+        reply = concurrent.futures.Future()
+        self._mbox.put((op, args, reply))
+        return await asyncio.wrap_future(reply)
+
+    def stop(self):
+        """
+        stops the acceptor's thread once it has handled the msgs already in its mailbox.
+        """
+        self._mbox.put((None, None, None))
+        self._thread.join()
 
+    async def prepare(self, ballot_number):
+        return await self._send("prepare", ballot_number)
 
-a1 = Acceptor(name='a1')
-a2 = Acceptor(name='a2')
-a3 = Acceptor(name='a3')
-a4 = Acceptor(name='a4')
-a5 = Acceptor(name='a5')
+    async def accept(self, ballot_number, new_state):
+        return await self._send("accept", ballot_number, new_state)
+
+    async def prepare_and_accept(self, ballot_number, new_state, next_ballot_number):
+        return await self._send("prepare_and_accept", ballot_number, new_state, next_ballot_number)
 
 
 def change_func(state):
@@ -259,11 +712,28 @@ def read_func(state):
 def set_func(state):
     return state + 3
 
-acceptorsList = [a1, a2, a3, a4, a5]
-p = Proposer(acceptors=acceptorsList)
-result = p.receive(change_func)
 
-print "result::", result
+def main():
+    logging.basicConfig(format='%(message)s\n', level=logging.INFO)
+
+    a1 = Acceptor(name='a1')
+    a2 = Acceptor(name='a2')
+    a3 = Acceptor(name='a3')
+    a4 = Acceptor(name='a4')
+    a5 = Acceptor(name='a5')
+
+    acceptorsList = [a1, a2, a3, a4, a5]
+    p = Proposer(acceptors=acceptorsList, node_id=1)
+    if uvloop is not None:
+        result = uvloop.run(p.receive(change_func))
+    else:
+        result = asyncio.run(p.receive(change_func))
+
+    print("result::", result)
+
+    for acceptor in acceptorsList:
+        print("acceptor accepted", acceptor.accepted)
+
 
-for acceptor in acceptorsList:
-    print "acceptor accepted", acceptor.accepted
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+import os
+import time
+import asyncio
+import tempfile
+import threading
+import unittest
+import concurrent.futures
+from unittest import mock
+
+from casPaxos import Status, Acceptor, ThreadedAcceptor, Proposer, Batcher, QuorumError, read_func
+
+
+class Unreachable:
+    """
+    an acceptor that never answers, eg because its node is down.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    async def _never(self, *args):
+        await asyncio.get_running_loop().create_future()
+
+    prepare = accept = prepare_and_accept = _never
+
+
+class Failing:
+    """
+    an acceptor whose disk fails.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    async def _fail(self, *args):
+        raise OSError("fsync failed")
+
+    prepare = accept = prepare_and_accept = _fail
+
+
+class Conflicting:
+    """
+    an acceptor that promises anything but has already accepted a value at a higher ballot number.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    async def prepare(self, ballot_number):
+        return (0, (0, 0))
+
+    async def accept(self, ballot_number, new_state):
+        return (Status.CONFLICT, (9, 9))
+
+    async def prepare_and_accept(self, ballot_number, new_state, next_ballot_number):
+        return (Status.CONFLICT, (9, 9))
+
+
+class Late:
+    """
+    an acceptor that handles 'accept' msgs right away but whose answers arrive late.
+    """
+
+    def __init__(self, acceptor, delay):
+        self.acceptor = acceptor
+        self.name = acceptor.name
+        self.delay = delay
+
+    async def prepare(self, ballot_number):
+        return await self.acceptor.prepare(ballot_number)
+
+    async def accept(self, ballot_number, new_state):
+        reply = await self.acceptor.accept(ballot_number, new_state)
+        await asyncio.sleep(self.delay)
+        return reply
+
+    async def prepare_and_accept(self, ballot_number, new_state, next_ballot_number):
+        reply = await self.acceptor.prepare_and_accept(ballot_number, new_state, next_ballot_number)
+        await asyncio.sleep(self.delay)
+        return reply
+
+
+class Blocking:
+    """
+    an acceptor that blocks the event loop for delay seconds before it answers, eg on a slow disk.
+    """
+
+    def __init__(self, acceptor, delay):
+        self.acceptor = acceptor
+        self.name = acceptor.name
+        self.delay = delay
+
+    async def prepare(self, ballot_number):
+        time.sleep(self.delay)
+        return await self.acceptor.prepare(ballot_number)
+
+    async def accept(self, ballot_number, new_state):
+        time.sleep(self.delay)
+        return await self.acceptor.accept(ballot_number, new_state)
+
+    async def prepare_and_accept(self, ballot_number, new_state, next_ballot_number):
+        time.sleep(self.delay)
+        return await self.acceptor.prepare_and_accept(ballot_number, new_state, next_ballot_number)
+
+
+class Gated(Acceptor):
+    """
+    an acceptor with a msg that holds up its thread until gate is set.
+    """
+
+    async def hold(self, gate):
+        gate.wait()
+
+
+class TestProposer(unittest.TestCase):
+    def test_chosen_value_survives_a_stale_partial_accept(self):
+        a1, a2, a3, a4, a5 = acceptors = [Acceptor(name="a{0}".format(i)) for i in range(1, 6)]
+
+        async def run():
+            p1 = Proposer(acceptors=acceptors, node_id=1)
+            self.assertEqual(await p1.receive(lambda state: 1), 1)
+
+            # another proposer gets 100 chosen on a1, a2 and a3, a majority of the five.
+            p2 = Proposer(acceptors=[a1, a2, a3], prepare_quorum=3, accept_quorum=3, node_id=2)
+            self.assertEqual(await p2.receive(lambda state: 100), 100)
+
+            # p1 still works off 1; only a4 and a5 can take its next value.
+            with self.assertRaises(QuorumError) as ctx:
+                await p1.receive(lambda state: state + 1)
+            self.assertEqual(ctx.exception.confirmed, 2)
+
+            # a proposer that only hears from a3, a4 and a5 still has to find 100.
+            p3 = Proposer(acceptors=[a3, a4, a5, Unreachable("a1"), Unreachable("a2")], timeout=0.5, node_id=3)
+            return await p3.receive(read_func)
+
+        self.assertEqual(asyncio.run(run()), 100)
+
+    def test_dead_acceptor_does_not_stall_rounds(self):
+        acceptors = [Unreachable("a1")] + [Acceptor(name="a{0}".format(i)) for i in range(2, 6)]
+        p = Proposer(acceptors=acceptors, timeout=2, node_id=1)
+
+        async def run():
+            return [await p.receive(lambda state: state + 1) for _ in range(3)]
+
+        start = time.monotonic()
+        self.assertEqual(asyncio.run(run()), [1, 2, 3])
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_concurrent_receives_get_their_own_state(self):
+        # late answers keep the first round waiting on its accept phase while the second one runs.
+        p = Proposer(acceptors=[Late(Acceptor(name="a{0}".format(i)), delay=0.1) for i in range(1, 6)], node_id=1)
+
+        async def run():
+            await p.receive(lambda state: 1)
+            return await asyncio.gather(p.receive(lambda state: state + 10), p.receive(lambda state: state + 100))
+
+        self.assertEqual(asyncio.run(run()), [11, 111])
+
+    def test_times_out_when_a_reply_arrives_at_the_deadline(self):
+        # a1 answers in the same loop iteration as the timer goes off; a2 and a3 never answer.
+        p = Proposer(
+            acceptors=[Blocking(Acceptor(name="a1"), delay=0.3), Unreachable("a2"), Unreachable("a3")],
+            timeout=0.2, node_id=1)
+
+        with self.assertRaises(QuorumError) as ctx:
+            asyncio.run(asyncio.wait_for(p.receive(lambda state: state + 1), 2))
+        self.assertEqual(ctx.exception.confirmed, 1)
+
+    def test_failing_acceptor_does_not_abort_the_round(self):
+        acceptors = [Failing("a1")] + [Acceptor(name="a{0}".format(i)) for i in range(2, 6)]
+        p = Proposer(acceptors=acceptors, node_id=1)
+        self.assertEqual(asyncio.run(p.receive(lambda state: state + 1)), 1)
+
+        # too many failures and it is a QuorumError like any other.
+        acceptors = [Failing("a{0}".format(i)) for i in range(1, 4)] + [Acceptor(name="a4"), Acceptor(name="a5")]
+        p = Proposer(acceptors=acceptors, node_id=1)
+        with self.assertRaises(QuorumError) as ctx:
+            asyncio.run(p.receive(lambda state: state + 1))
+        self.assertEqual(ctx.exception.unanswered, 3)
+
+    def test_no_retry_while_accepts_are_unanswered(self):
+        late = [Acceptor(name="a{0}".format(i)) for i in range(3, 6)]
+        p = Proposer(
+            acceptors=[Conflicting("a1"), Conflicting("a2")] + [Late(a, delay=1) for a in late], timeout=0.2, node_id=1)
+
+        with self.assertRaises(QuorumError) as ctx:
+            asyncio.run(p.receive(lambda state: state + 1))
+        self.assertEqual(ctx.exception.confirmed, 0)
+        self.assertEqual(ctx.exception.unanswered, 3)
+        # a retry would have read 1 back from them and applied f again.
+        self.assertEqual([a.accepted[0] for a in late], [1, 1, 1])
+
+
+class TestBatcher(unittest.TestCase):
+    def test_submits_share_rounds(self):
+        p = Proposer(acceptors=[Acceptor(name="a{0}".format(i)) for i in range(1, 4)], node_id=1)
+        # made outside of any event loop, like a client would.
+        batcher = Batcher(p, batch_window_ms=100, max_batch=3)
+
+        async def run():
+            runner = asyncio.create_task(batcher.run())
+            # the first three fill up a batch, the other two wait out the batch window.
+            states = await asyncio.gather(*[batcher.submit(lambda state: state + 1) for _ in range(5)])
+            # a change that comes in within the window joins the batch.
+            first = asyncio.create_task(batcher.submit(lambda state: state + 10))
+            await asyncio.sleep(0.01)
+            states += await asyncio.gather(first, batcher.submit(lambda state: state + 100))
+            runner.cancel()
+            return states
+
+        with mock.patch.object(
+                Proposer, "batch_receive", autospec=True, side_effect=Proposer.batch_receive) as batch_receive:
+            self.assertEqual(asyncio.run(run()), [1, 2, 3, 4, 5, 15, 115])
+        self.assertEqual([len(args[1]) for args, _ in batch_receive.call_args_list], [3, 2, 2])
+
+    def test_cancelling_the_batcher_cancels_its_batch(self):
+        p = Proposer(acceptors=[Unreachable("a{0}".format(i)) for i in range(1, 4)], node_id=1)
+        batcher = Batcher(p)
+
+        async def run():
+            runner = asyncio.create_task(batcher.run())
+            submits = [asyncio.create_task(batcher.submit(lambda state: state + 1)) for _ in range(3)]
+            await asyncio.sleep(0.05)  # the batch is now stuck in its round
+            runner.cancel()
+            return await asyncio.wait_for(asyncio.gather(*submits, return_exceptions=True), 1)
+
+        replies = asyncio.run(run())
+        self.assertTrue(all(isinstance(reply, asyncio.CancelledError) for reply in replies))
+
+
+class TestAcceptor(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "a1.log")
+
+    def test_recovers_from_a_torn_record(self):
+        a = Acceptor(name="a1", path=self.path)
+        asyncio.run(a.prepare_and_accept((1, 1), "x", (2, 1)))
+        a.close()
+        # a crash half way through writing the next record.
+        with open(self.path, "ab") as f:
+            f.write(b"\x00\x00\x00\x40\x12")
+
+        a = Acceptor(name="a1", path=self.path)
+        self.assertEqual((a.promise, a.accepted), ((2, 1), ("x", (1, 1))))
+        asyncio.run(a.accept((2, 1), "y"))
+        a.close()
+
+        a = Acceptor(name="a1", path=self.path)
+        self.assertEqual((a.promise, a.accepted), ((0, 0), ("y", (2, 1))))
+        a.close()
+
+    def test_rejects_state_it_can_not_persist(self):
+        a = Acceptor(name="a1", path=self.path)
+        asyncio.run(a.accept((1, 1), "x"))
+        with self.assertRaisesRegex(TypeError, "pickle"):
+            asyncio.run(a.accept((2, 1), threading.Lock()))
+        self.assertEqual(a.accepted, ("x", (1, 1)))
+        a.close()
+
+        a = Acceptor(name="a1", path=self.path)
+        self.assertEqual(a.accepted, ("x", (1, 1)))
+        a.close()
+
+    def test_concurrent_msgs_share_a_write(self):
+        a = Acceptor(name="a1", path=self.path)
+
+        async def run():
+            return await asyncio.gather(a.prepare((1, 1)), a.accept((2, 1), "x"))
+
+        with mock.patch.object(Acceptor, "_write", autospec=True, side_effect=Acceptor._write) as write:
+            self.assertEqual(asyncio.run(run()), [(0, (0, 0)), (Status.CONFIRM, Status.CONFIRM)])
+        self.assertEqual(write.call_count, 1)
+        a.close()
+
+        a = Acceptor(name="a1", path=self.path)
+        self.assertEqual((a.promise, a.accepted), ((0, 0), ("x", (2, 1))))
+        a.close()
+
+    def test_keeps_writing_after_a_short_write(self):
+        write = os.write
+
+        def short_write(fd, data):
+            return write(fd, bytes(data[:3]))
+
+        a = Acceptor(name="a1", path=self.path)
+        with mock.patch("os.write", short_write):
+            asyncio.run(a.prepare_and_accept((1, 1), "x", (2, 1)))
+        a.close()
+
+        a = Acceptor(name="a1", path=self.path)
+        self.assertEqual((a.promise, a.accepted), ((2, 1), ("x", (1, 1))))
+        a.close()
+
+    def test_fails_once_its_log_does(self):
+        a = Acceptor(name="a1", path=self.path)
+        asyncio.run(a.accept((1, 1), "x"))
+        with mock.patch("os.fsync", side_effect=OSError("fsync failed")):
+            with self.assertRaises(OSError):
+                asyncio.run(a.accept((2, 1), "y"))
+        # back to what is known to be on disk.
+        self.assertEqual((a.promise, a.accepted), ((0, 0), ("x", (1, 1))))
+
+        # the disk is back, but we can not tell what made it there.
+        with self.assertRaises(OSError):
+            asyncio.run(a.prepare((3, 1)))
+        self.assertEqual((a.promise, a.accepted), ((0, 0), ("x", (1, 1))))
+        a.close()
+
+        # a restart reads the log back and takes msgs again.
+        a = Acceptor(name="a1", path=self.path)
+        asyncio.run(a.accept((3, 1), "z"))
+        a.close()
+        a = Acceptor(name="a1", path=self.path)
+        self.assertEqual(a.accepted, ("z", (3, 1)))
+        a.close()
+
+
+class TestThreadedAcceptor(unittest.TestCase):
+    def test_receive(self):
+        acceptors = [ThreadedAcceptor(Acceptor(name="a{0}".format(i))) for i in range(1, 4)]
+        for a in acceptors:
+            self.addCleanup(a.stop)
+        p = Proposer(acceptors=acceptors, node_id=1)
+
+        async def run():
+            return [await p.receive(lambda state: state + 1) for _ in range(3)]
+
+        self.assertEqual(asyncio.run(run()), [1, 2, 3])
+        # the last accept may have been cancelled before it got to the slowest acceptor.
+        self.assertGreaterEqual([a.accepted[0] for a in acceptors].count(3), 2)
+
+    def test_stop_handles_the_msgs_already_queued(self):
+        a = ThreadedAcceptor(Acceptor(name="a1"))
+        reply = concurrent.futures.Future()
+        a._mbox.put(("accept", ((1, 1), "x"), reply))
+        a.stop()
+        self.assertFalse(a._thread.is_alive())
+        self.assertEqual(reply.result(0)[0], Status.CONFIRM)
+        self.assertEqual(a.accepted, ("x", (1, 1)))
+
+    def test_skips_msgs_nobody_waits_for(self):
+        a = ThreadedAcceptor(Acceptor(name="a1"))
+        self.addCleanup(a.stop)
+        reply = concurrent.futures.Future()
+        reply.cancel()
+        a._mbox.put(("accept", ((1, 1), "x"), reply))
+        # still serving, and the cancelled msg was never handled.
+        self.assertEqual(asyncio.run(a.prepare((2, 1))), (0, (0, 0)))
+        self.assertEqual(a.accepted, (0, (0, 0)))
+
+    def test_queued_msgs_share_a_flush(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        a = ThreadedAcceptor(Gated(name="a1", path=os.path.join(tmp.name, "a1.log")))
+        self.addCleanup(a.close)
+        self.addCleanup(a.stop)
+
+        gate = threading.Event()
+        a._mbox.put(("hold", (gate,), concurrent.futures.Future()))
+        replies = [concurrent.futures.Future() for _ in range(3)]
+        for i, reply in enumerate(replies, 1):
+            a._mbox.put(("prepare", ((i, 1),), reply))
+
+        with mock.patch.object(Acceptor, "_write", autospec=True, side_effect=Acceptor._write) as write:
+            gate.set()
+            self.assertEqual([reply.result(2) for reply in replies], [(0, (0, 0))] * 3)
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(a.promise, (3, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()